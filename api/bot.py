@@ -1,18 +1,43 @@
 import os
+import asyncio
+import html
 import logging
+import logging.handlers
+import queue
 import json
+import re
+import weakref
+import orjson
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import Forbidden, RetryAfter
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+    AIORateLimiter, ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 )
-from fastapi import FastAPI, Request
+from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi.responses import ORJSONResponse
 import uvicorn
 
+# --- Logging ---
+# Handlers only enqueue records; a QueueListener thread does the actual stdout writes,
+# keeping blocking I/O off the event loop. Configured before importing lib.supabase (which can log at import)
+# so basicConfig takes effect for every record.
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+# Records are fully formatted by log_stream_handler; the queue side passes the message through untouched
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[log_queue_handler])
+log_listener.start()
+logger = logging.getLogger(__name__)
+
 # Import Supabase helper functions from your lib folder
 from lib.supabase import (
-    is_user_registered, register_user, get_registered_user_count,
-    get_registered_users_list, log_admin_action
+    is_user_registered, register_user_if_new, get_registered_user_count,
+    get_broadcast_targets, mark_users_blocked, get_registered_users_chunks, log_admin_action,
+    flush_admin_logs, stop_admin_log_writer, close_supabase_client
 )
 
 # Load environment variables for local development
@@ -23,23 +48,54 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_ID = int(os.environ.get("ADMIN_ID")) if os.environ.get("ADMIN_ID") else None
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME") # Optional
 
+# Max number of concurrent sends during a /notify broadcast (Telegram caps bots at ~30 msg/sec overall)
+BROADCAST_CONCURRENCY = 25
+# How many times to attempt a send when Telegram answers with a flood-control RetryAfter
+SEND_MAX_ATTEMPTS = 3
+
 # Basic error checking for critical variables
 if not BOT_TOKEN:
     logging.error("BOT_TOKEN not found. Bot cannot start.")
+    log_listener.stop() # Flush the error before exiting
     exit(1) # In a serverless context, this exits the current invocation
 
 if ADMIN_ID is None:
     logging.warning("ADMIN_ID not set. Admin commands will not function correctly.")
 
 # --- Bot Setup ---
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# Create the Telegram Application
-application = ApplicationBuilder().token(BOT_TOKEN).build()
+# Bot API read timeout in seconds; fail fast rather than hang until the serverless function times out
+BOT_API_READ_TIMEOUT = 5
+
+# The Telegram Application is built lazily by get_application(), once per container
+application = None
+application_lock = asyncio.Lock()
+
+# --- Outgoing Message Ordering ---
+# Sends to the same chat go one at a time (preserving order, 1 msg/chat at a time),
+# while sends to different chats run in parallel up to BROADCAST_CONCURRENCY.
+# Locks are weakly held so idle chats don't accumulate in memory.
+chat_send_locks = weakref.WeakValueDictionary()
+send_semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+def get_chat_send_lock(chat_id: int) -> asyncio.Lock:
+    lock = chat_send_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        chat_send_locks[chat_id] = lock
+    return lock
+
+async def send_message_in_order(bot, chat_id: int, text: str):
+    async with get_chat_send_lock(chat_id):
+        for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+            try:
+                async with send_semaphore:
+                    return await bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                if attempt == SEND_MAX_ATTEMPTS:
+                    raise
+                # Wait out the flood control (without holding a send slot) and try again
+                logger.warning(f"[SEND] Flood control for chat {chat_id}, retrying in {e.retry_after}s (attempt {attempt}/{SEND_MAX_ATTEMPTS}).")
+                await asyncio.sleep(e.retry_after + 0.1)
 
 # --- Middleware for Admin Check ---
 async def is_admin(update: Update, context):
@@ -49,6 +105,13 @@ async def is_admin(update: Update, context):
     return False
 
 # --- /start Command ---
+# Static parts of the registration prompt; only the per-user lines are built per call
+REGISTRATION_PROMPT_HEAD = (
+    "Hello {name}! I see you're not yet registered.\n\n"
+    "I'll collect the following information to keep you updated:\n"
+)
+REGISTRATION_PROMPT_TAIL = "Would you like to register for updates about the Portfolio Showcase app?"
+
 async def start_command(update: Update, context):
     user = update.effective_user
     telegram_id = user.id
@@ -70,13 +133,16 @@ async def start_command(update: Update, context):
             await update.message.reply_text("You’re already registered. I’ll notify you when the app is live.")
         else:
             # User is NOT registered, prompt for confirmation
+            username_line = (
+                f"• Your Username: <code>@{html.escape(username)}</code>\n" if username
+                else "• Your Username: <code>Not available</code> (You can set one in Telegram settings!)\n"
+            )
             registration_prompt = (
-                f"Hello {first_name or 'there'}! I see you're not yet registered.\n\n"
-                "I'll collect the following information to keep you updated:\n"
-                f"• Your Telegram ID: `{telegram_id}`\n"
-                f"• Your Username: `@{username}`\n" if username else "• Your Username: `Not available` (You can set one in Telegram settings!)\n"
-                f"• Your First Name: `{first_name or 'Not provided'}`\n\n"
-                "Would you like to register for updates about the Portfolio Showcase app?"
+                REGISTRATION_PROMPT_HEAD.format(name=html.escape(first_name or 'there'))
+                + f"• Your Telegram ID: <code>{telegram_id}</code>\n"
+                + username_line
+                + f"• Your First Name: <code>{html.escape(first_name or 'Not provided')}</code>\n\n"
+                + REGISTRATION_PROMPT_TAIL
             )
 
             keyboard_buttons = [
@@ -96,7 +162,7 @@ async def start_command(update: Update, context):
             await update.message.reply_text(
                 registration_prompt,
                 reply_markup=reply_markup,
-                parse_mode='Markdown'
+                parse_mode='HTML'
             )
 
     except Exception as e:
@@ -104,13 +170,16 @@ async def start_command(update: Update, context):
         await update.message.reply_text("Something went wrong, please try again later.")
 
 # --- Callback Query Handler for Registration Buttons ---
+# Matches "register_yes:<telegram_id>" and "register_no"
+REGISTRATION_CALLBACK_PATTERN = re.compile(r'^register_(?P<action>yes|no)(?::(?P<telegram_id>\d+))?$')
+
 async def registration_callback(update: Update, context):
     query = update.callback_query
-    await query.answer() # Acknowledge the callback query
 
-    callback_data = query.data
-    action = callback_data.split(':')[0]
-    telegram_id_from_callback = int(callback_data.split(':')[1]) if ':' in callback_data else None
+    # Parsed by the handler's pattern (REGISTRATION_CALLBACK_PATTERN)
+    match = context.matches[0]
+    action = 'register_' + match.group('action')
+    telegram_id_from_callback = int(match.group('telegram_id')) if match.group('telegram_id') else None
     current_telegram_id = query.from_user.id
     first_name = query.from_user.first_name or 'there'
 
@@ -118,25 +187,21 @@ async def registration_callback(update: Update, context):
 
     # Security check: ensure the button click is from the user who initiated it
     if telegram_id_from_callback and telegram_id_from_callback != current_telegram_id:
+        await query.answer()
         await query.edit_message_text("This registration prompt is not for you.")
         return
 
+    if action == 'register_no':
+        logger.info(f"[CALLBACK ACTION] User {current_telegram_id} clicked 'no'.")
+        # Show the reply in the callback answer itself, saving a separate edit_message_text call
+        await query.answer(text="No problem! You can type /start again anytime if you change your mind.")
+        return
+
+    await query.answer() # Acknowledge the callback query
+
     try:
         if action == 'register_yes':
             username = query.from_user.username
-            
-            already_registered = await is_user_registered(current_telegram_id)
-            if already_registered is None:
-                logger.error(f"[CALLBACK ACTION] Supabase error during is_user_registered for action 'yes'.")
-                await query.edit_message_text("Something went wrong, please try again later.")
-                return
-            if already_registered:
-                logger.info(f"[CALLBACK ACTION] User {current_telegram_id} already registered, clicked 'yes'.")
-                await query.edit_message_text(
-                    "You’re already registered. I’ll notify you when the app is live.",
-                    parse_mode='Markdown'
-                )
-                return
 
             user_data = {
                 "telegram_id": current_telegram_id,
@@ -144,26 +209,27 @@ async def registration_callback(update: Update, context):
                 "first_name": query.from_user.first_name or 'N/A'
             }
 
-            registration_result = await register_user(user_data)
+            # Single insert-if-absent instead of a lookup followed by an insert
+            newly_registered = await register_user_if_new(user_data)
 
-            if registration_result:
+            if newly_registered is None:
+                logger.error(f"[CALLBACK ACTION] Failed to register user {current_telegram_id}.")
+                await query.edit_message_text(
+                    "Something went wrong during registration, please try again later.",
+                    parse_mode='HTML'
+                )
+            elif newly_registered:
                 logger.info(f"[CALLBACK ACTION] User {current_telegram_id} successfully registered.")
                 await query.edit_message_text(
-                    f"🎉 Great! Thanks for registering, {first_name}! I’ll notify you when the Portfolio Showcase app is ready.",
-                    parse_mode='Markdown'
+                    f"🎉 Great! Thanks for registering, {html.escape(first_name)}! I’ll notify you when the Portfolio Showcase app is ready.",
+                    parse_mode='HTML'
                 )
             else:
-                logger.error(f"[CALLBACK ACTION] Failed to register user {current_telegram_id}.")
+                logger.info(f"[CALLBACK ACTION] User {current_telegram_id} already registered, clicked 'yes'.")
                 await query.edit_message_text(
-                    "Something went wrong during registration, please try again later.",
-                    parse_mode='Markdown'
+                    "You’re already registered. I’ll notify you when the app is live.",
+                    parse_mode='HTML'
                 )
-        elif action == 'register_no':
-            logger.info(f"[CALLBACK ACTION] User {current_telegram_id} clicked 'no'.")
-            await query.edit_message_text(
-                "No problem! You can type /start again anytime if you change your mind.",
-                parse_mode='Markdown'
-            )
     except Exception as e:
         logger.exception("[CALLBACK ACTION] Unhandled error in registration action.")
         await query.edit_message_text("Something went wrong, please try again later.")
@@ -212,25 +278,25 @@ async def list_command(update: Update, context):
     logger.info(f"[ADMIN COMMAND] Admin {admin_id} initiated /list.")
 
     try:
-        users = await get_registered_users_list()
-        if users is None:
-            logger.error("[ADMIN COMMAND] Supabase error during get_registered_users_list.")
+        # Formatted and paged by Postgres, so large lists don't exceed Telegram's 4096-char message limit
+        chunks = await get_registered_users_chunks()
+        if chunks is None:
+            logger.error("[ADMIN COMMAND] Supabase error during get_registered_users_chunks.")
             await update.message.reply_text("Something went wrong while fetching the user list, please try again later.")
             await log_admin_action({"admin_telegram_id": admin_id, "action": "list_users_failed", "details": "Database error fetching list."})
             return
 
-        if not users:
+        if not chunks:
             logger.info("[ADMIN COMMAND] No registered users found for /list.")
             await update.message.reply_text("No users are currently registered.")
             await log_admin_action({"admin_telegram_id": admin_id, "action": "list_users", "details": "No registered users."})
             return
 
-        user_list = "\n".join([
-            f"- `{user['telegram_id']}`" + (f" (@{user['username']})" if user.get('username') else "")
-            for user in users
-        ])
-        await update.message.reply_text(f"Registered Users:\n{user_list}", parse_mode='Markdown')
-        await log_admin_action({"admin_telegram_id": admin_id, "action": "list_users", "details": f"Returned {len(users)} users."})
+        user_count = sum(chunk.count("\n") + 1 for chunk in chunks)
+        await update.message.reply_text(f"Registered Users:\n{chunks[0]}", parse_mode='HTML')
+        for chunk in chunks[1:]:
+            await update.message.reply_text(chunk, parse_mode='HTML')
+        await log_admin_action({"admin_telegram_id": admin_id, "action": "list_users", "details": f"Returned {user_count} users in {len(chunks)} messages."})
 
     except Exception as e:
         logger.exception("[ADMIN COMMAND] Unhandled error in /list command.")
@@ -245,14 +311,14 @@ async def notify_command(update: Update, context):
     message_text = " ".join(context.args)
     if not message_text:
         logger.warning("[ADMIN COMMAND] Notify command used without message text.")
-        await update.message.reply_text("Please provide a message to send. Example: `/notify The app is now live!`", parse_mode='Markdown')
+        await update.message.reply_text("Please provide a message to send. Example: <code>/notify The app is now live!</code>", parse_mode='HTML')
         await log_admin_action({"admin_telegram_id": admin_id, "action": "notify_failed", "details": "No message text provided."})
         return
 
     try:
-        users = await get_registered_users_list()
+        users = await get_broadcast_targets()
         if users is None:
-            logger.error("[ADMIN COMMAND] Supabase error during get_registered_users_list for /notify.")
+            logger.error("[ADMIN COMMAND] Supabase error during get_broadcast_targets for /notify.")
             await update.message.reply_text("Something went wrong while fetching the user list for notification, please try again later.")
             await log_admin_action({"admin_telegram_id": admin_id, "action": "notify_failed", "details": "Database error fetching user list for broadcast."})
             return
@@ -263,24 +329,46 @@ async def notify_command(update: Update, context):
             await log_admin_action({"admin_telegram_id": admin_id, "action": "notify_attempt_no_users", "details": "No registered users to send broadcast to."})
             return
 
+        # Send concurrently across chats, bounded so we don't flood the Bot API
+        async def _send(user):
+            try:
+                await send_message_in_order(context.bot, user['telegram_id'], message_text)
+                return user, None
+            except Exception as send_error:
+                return user, send_error
+
+        results = await asyncio.gather(*[_send(user) for user in users])
+
         successful_sends = 0
         failed_sends = 0
         failed_user_ids = []
+        blocked_user_ids = []
 
-        for user in users:
-            try:
-                await context.bot.send_message(chat_id=user['telegram_id'], text=message_text)
+        for user, send_error in results:
+            if send_error is None:
                 successful_sends += 1
-            except Exception as send_error:
-                logger.warning(f"[ADMIN COMMAND] Failed to send message to user {user['telegram_id']} ({user.get('username', 'N/A')}): {send_error}")
+            elif isinstance(send_error, Forbidden):
+                # The user blocked the bot; no point retrying or messaging them again
+                logger.info(f"[ADMIN COMMAND] User {user['telegram_id']} has blocked the bot.")
+                blocked_user_ids.append(user['telegram_id'])
+            else:
+                logger.warning(f"[ADMIN COMMAND] Failed to send message to user {user['telegram_id']}: {send_error}")
                 failed_sends += 1
                 failed_user_ids.append(str(user['telegram_id']))
 
-        await update.message.reply_text(f"Broadcast complete! Sent to {successful_sends} users. Failed for {failed_sends} users.")
+        summary = f"Broadcast complete! Sent to {successful_sends} users. Failed for {failed_sends} users."
+        if blocked_user_ids:
+            if await mark_users_blocked(blocked_user_ids):
+                summary += f" {len(blocked_user_ids)} users have blocked the bot and will be skipped from now on."
+            else:
+                logger.error("[ADMIN COMMAND] Supabase error during mark_users_blocked.")
+                summary += f" {len(blocked_user_ids)} users have blocked the bot (could not mark them as blocked)."
+
+        await update.message.reply_text(summary)
         await log_admin_action({
             "admin_telegram_id": admin_id,
             "action": "broadcast_message",
-            "details": f"Message: \"{message_text}\" | Sent: {successful_sends}, Failed: {failed_sends} (IDs: {', '.join(failed_user_ids) or 'N/A'})"
+            "details": f"Message: \"{message_text}\" | Sent: {successful_sends}, Failed: {failed_sends} (IDs: {', '.join(failed_user_ids) or 'N/A'}), Blocked: {len(blocked_user_ids)}"
         })
 
     except Exception as e:
@@ -294,31 +382,89 @@ async def generic_message_handler(update: Update, context):
         logger.info(f"[MESSAGE HANDLER] User {update.effective_user.id} sent non-command message: '{update.message.text}'.")
         await update.message.reply_text("I'm a registration bot! Please use commands like /start or /help.")
 
-# --- Register Handlers ---
-application.add_handler(CommandHandler("start", start_command))
-application.add_handler(CommandHandler("help", help_command))
-application.add_handler(CommandHandler("count", count_command))
-application.add_handler(CommandHandler("list", list_command))
-application.add_handler(CommandHandler("notify", notify_command))
-application.add_handler(CallbackQueryHandler(registration_callback, pattern=r'register_(yes|no):\d+'))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, generic_message_handler))
+# --- Application Setup ---
+def build_application():
+    # AIORateLimiter throttles requests to stay under Telegram's flood limits. It doesn't retry on 429s
+    # (max_retries defaults to 0); send_message_in_order handles RetryAfter itself
+    new_application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .read_timeout(BOT_API_READ_TIMEOUT)
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30, overall_time_period=1,
+            group_max_rate=20, group_time_period=60
+        ))
+        .build()
+    )
+
+    # --- Register Handlers ---
+    new_application.add_handler(CommandHandler("start", start_command))
+    new_application.add_handler(CommandHandler("help", help_command))
+    new_application.add_handler(CommandHandler("count", count_command))
+    new_application.add_handler(CommandHandler("list", list_command))
+    new_application.add_handler(CommandHandler("notify", notify_command))
+    new_application.add_handler(CallbackQueryHandler(registration_callback, pattern=REGISTRATION_CALLBACK_PATTERN))
+    new_application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, generic_message_handler))
+    return new_application
+
+async def get_application():
+    """Builds and initializes the Telegram Application on first use, then reuses it."""
+    global application
+    if application is None:
+        async with application_lock:
+            if application is None:
+                new_application = build_application()
+                await new_application.initialize()
+                application = new_application
+                logger.info("[SETUP] Telegram application initialized.")
+    return application
 
 # --- Vercel Serverless Function Export ---
 # FastAPI app to handle Vercel's HTTP requests
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+@app.on_event("shutdown")
+async def flush_pending_admin_logs():
+    await stop_admin_log_writer()
+
+@app.on_event("shutdown")
+async def close_database_connections():
+    close_supabase_client()
+
+@app.on_event("shutdown")
+async def shutdown_application():
+    if application is not None:
+        await application.shutdown()
+
+@app.on_event("shutdown")
+async def stop_log_listener():
+    # Flushes any queued log records
+    log_listener.stop()
+
+async def process_update_in_background(application, update: Update):
+    try:
+        await application.process_update(update)
+        logger.info("[WEBHOOK] Telegram update processed.")
+    except Exception:
+        logger.exception("[WEBHOOK] Unhandled error while processing Telegram update.")
+    finally:
+        # Write admin logs before the invocation ends; serverless instances may be frozen or recycled afterwards
+        await flush_admin_logs()
 
 @app.post("/api/bot")
-async def webhook_handler(request: Request):
+async def webhook_handler(request: Request, background_tasks: BackgroundTasks):
     logger.info(f"[WEBHOOK] Received request: Method={request.method}, URL={request.url}")
     if request.method == "POST":
         # Get the update from the request body
-        body = await request.json()
+        application = await get_application()
+        body = orjson.loads(await request.body())
         update = Update.de_json(body, application.bot)
-        logger.info("[WEBHOOK] Processing Telegram update...")
+        logger.info("[WEBHOOK] Scheduling Telegram update for processing...")
 
-        # Process the update
-        await application.process_update(update)
-        logger.info("[WEBHOOK] Telegram update processed.")
+        # Ack Telegram right away and process the update after the response is sent,
+        # so slow handlers (DB calls, broadcasts) don't trigger Telegram redeliveries.
+        # BackgroundTasks (rather than a bare create_task) keeps the invocation alive until it finishes.
+        background_tasks.add_task(process_update_in_background, application, update)
         return {"status": "ok"}
     else:
         logger.info("[WEBHOOK] Non-POST request received. Responding with info.")
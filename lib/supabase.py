@@ -1,5 +1,11 @@
 import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+from functools import lru_cache
+from cachetools import TTLCache
 from supabase import create_client, Client
+from supabase.lib.client_options import ClientOptions
 from dotenv import load_dotenv
 
 # Load environment variables for local development
@@ -8,63 +14,214 @@ load_dotenv()
 SUPABASE_URL: str = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY: str = os.environ.get("SUPABASE_KEY")
 
+logger = logging.getLogger(__name__)
+
 if not SUPABASE_URL or not SUPABASE_KEY:
-    print("Error: Supabase URL or Key not found in environment variables. Ensure .env or Vercel config is set.")
+    logger.error("Supabase URL or Key not found in environment variables. Ensure .env or Vercel config is set.")
     # In a production serverless function, this might still allow the function to run but fail on DB calls.
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Registration status per telegram_id, so repeated /start taps don't each hit the database.
+# No locking needed: it's only touched from the (single-threaded) event loop.
+_registration_cache = TTLCache(maxsize=10_000, ttl=300)
+
+# Whole-table user lists for admin commands, keyed by helper name, so repeated /list or /notify
+# within a short window reuse one fetch. Cleared whenever registrations change.
+_users_cache = TTLCache(maxsize=8, ttl=30)
+
+# Admin actions are buffered and written in batches by flush_admin_logs, keeping the logging
+# insert off the admin commands' reply path. Callers flush before their request finishes;
+# run_admin_log_writer is a fallback for entries logged outside a request.
+ADMIN_LOG_BATCH_SIZE = 50
+ADMIN_LOG_FLUSH_INTERVAL = 1.0  # seconds
+_admin_log_buffer: list[dict] = []
+_admin_log_pending = asyncio.Event()
+_admin_log_writer_task: asyncio.Task | None = None
+
+# Max telegram_ids per mark_users_blocked update, since they're sent in the request URL
+MARK_BLOCKED_BATCH_SIZE = 200
+
+# Fail fast instead of hanging until the serverless function times out
+SUPABASE_CLIENT_TIMEOUT = 10  # seconds
+
+@lru_cache(maxsize=1)
+def get_supabase_client() -> Client:
+    """Returns the shared Supabase client, creating it on first use.
+
+    Reusing one client keeps its pooled HTTP connections alive between queries.
+    """
+    return create_client(
+        SUPABASE_URL,
+        SUPABASE_KEY,
+        options=ClientOptions(
+            postgrest_client_timeout=SUPABASE_CLIENT_TIMEOUT,
+            storage_client_timeout=SUPABASE_CLIENT_TIMEOUT,
+        ),
+    )
+
+def close_supabase_client():
+    """Closes the shared client's HTTP connections, if the client was ever created."""
+    if get_supabase_client.cache_info().currsize:
+        get_supabase_client().postgrest.session.close()
+        get_supabase_client.cache_clear()
 
 def _log_error(context: str, error_details: any):
     """Helper to log errors consistently."""
-    print(f"[Supabase Error - {context}]: {error_details}")
+    logger.error("[Supabase Error - %s]: %s", context, error_details)
+
+async def _execute(query):
+    """Runs a blocking supabase-py query in a worker thread so it doesn't stall the event loop."""
+    return await asyncio.to_thread(query.execute)
 
 async def is_user_registered(telegram_id: int) -> bool | None:
-    """Checks if a user is already registered."""
+    """Checks if a user is already registered.
+
+    Users marked as having blocked the bot count as unregistered, so /start offers them registration again.
+    """
+    # Single lookup: an entry can expire between an `in` check and the read
+    cached = _registration_cache.get(telegram_id)
+    if cached is not None:
+        return cached
     try:
-        response = supabase.table("registrations").select("telegram_id").eq("telegram_id", telegram_id).execute()
+        response = await _execute(get_supabase_client().table("registrations").select("telegram_id, blocked_at").eq("telegram_id", telegram_id))
         # The 'data' field will be an empty list if no rows are found, or a list with dicts if found
-        return bool(response.data)
+        registered = bool(response.data) and response.data[0]["blocked_at"] is None
+        _registration_cache[telegram_id] = registered
+        return registered
     except Exception as e:
         _log_error("is_user_registered", e)
         return None
 
-async def register_user(user_data: dict) -> dict | None:
-    """Registers a new user."""
+async def register_user_if_new(user_data: dict) -> bool | None:
+    """Registers a user unless already registered, in a single round-trip.
+
+    Returns True if a new row was inserted (or a user who had blocked the bot was reactivated),
+    False if the user was already registered.
+    """
     try:
-        response = supabase.table("registrations").insert(user_data).execute()
-        if response.data:
-            return response.data[0] # Return the first inserted row
-        return None
+        response = await _execute(
+            get_supabase_client().table("registrations").upsert(user_data, on_conflict="telegram_id", ignore_duplicates=True)
+        )
+        # With ignore_duplicates, a conflicting row is skipped and nothing is returned
+        registered = bool(response.data)
+        if not registered:
+            # Existing row: if the user had blocked the bot and came back, reactivate it with their current details
+            response = await _execute(
+                get_supabase_client().table("registrations")
+                .update({**user_data, "blocked_at": None})
+                .eq("telegram_id", user_data["telegram_id"])
+                .not_.is_("blocked_at", "null")
+            )
+            registered = bool(response.data)
+        # Either way the user is registered now
+        _registration_cache[user_data["telegram_id"]] = True
+        if registered:
+            _users_cache.clear()
+        return registered
     except Exception as e:
-        _log_error("register_user", e)
+        _log_error("register_user_if_new", e)
         return None
 
 async def get_registered_user_count() -> int | None:
-    """Gets the total number of registered users."""
+    """Gets the total number of registered users (excluding those who blocked the bot)."""
     try:
-        # Supabase Python client's select().count() method directly returns the count
-        response = supabase.table("registrations").select("count", head=True).execute()
+        # HEAD request with an exact count: only the Content-Range header comes back, no rows
+        response = await _execute(
+            get_supabase_client().table("registrations").select("*", count="exact", head=True).is_("blocked_at", "null")
+        )
         return response.count
     except Exception as e:
         _log_error("get_registered_user_count", e)
         return None
 
-async def get_registered_users_list() -> list[dict] | None:
-    """Gets a list of all registered usernames and IDs."""
+async def get_broadcast_targets() -> list[dict] | None:
+    """Gets the telegram_id of every registered user who hasn't blocked the bot, for broadcasts."""
+    cached = _users_cache.get("get_broadcast_targets")
+    if cached is not None:
+        return cached
     try:
-        response = supabase.table("registrations").select("telegram_id, username").execute()
+        response = await _execute(get_supabase_client().table("registrations").select("telegram_id").is_("blocked_at", "null"))
+        _users_cache["get_broadcast_targets"] = response.data
         return response.data
     except Exception as e:
-        _log_error("get_registered_users_list", e)
+        _log_error("get_broadcast_targets", e)
         return None
 
-async def log_admin_action(log_data: dict) -> dict | None:
-    """Logs an admin action."""
+async def mark_users_blocked(telegram_ids: list[int]) -> bool:
+    """Soft-deletes users who blocked the bot so future broadcasts skip them.
+
+    Returns False if any batch failed to update.
+    """
+    blocked_at = datetime.now(timezone.utc).isoformat()
+    success = True
+    for start in range(0, len(telegram_ids), MARK_BLOCKED_BATCH_SIZE):
+        batch = telegram_ids[start:start + MARK_BLOCKED_BATCH_SIZE]
+        try:
+            await _execute(
+                get_supabase_client().table("registrations")
+                .update({"blocked_at": blocked_at})
+                .in_("telegram_id", batch)
+            )
+            for telegram_id in batch:
+                _registration_cache[telegram_id] = False
+        except Exception as e:
+            _log_error("mark_users_blocked", e)
+            success = False
+    _users_cache.clear()
+    return success
+
+async def get_registered_users_chunks() -> list[str] | None:
+    """Gets the registered users list pre-formatted by Postgres, split into message-sized chunks."""
+    cached = _users_cache.get("get_registered_users_chunks")
+    if cached is not None:
+        return cached
     try:
-        response = supabase.table("admin_logs").insert(log_data).execute()
-        if response.data:
-            return response.data[0]
-        return None
+        response = await _execute(get_supabase_client().rpc("list_registered_chunks", {}))
+        chunks = [row["chunk"] for row in response.data]
+        _users_cache["get_registered_users_chunks"] = chunks
+        return chunks
     except Exception as e:
-        _log_error("log_admin_action", e)
-        return None
\ No newline at end of file
+        _log_error("get_registered_users_chunks", e)
+        return None
+
+async def log_admin_action(log_data: dict) -> None:
+    """Buffers an admin action to be written by flush_admin_logs."""
+    _admin_log_buffer.append(log_data)
+    _admin_log_pending.set()
+    _ensure_admin_log_writer()
+
+async def flush_admin_logs():
+    """Writes all buffered admin actions, in inserts of up to ADMIN_LOG_BATCH_SIZE entries."""
+    _admin_log_pending.clear()
+    while _admin_log_buffer:
+        # Entries leave the buffer before the insert starts, so they are never written twice
+        batch = _admin_log_buffer[:ADMIN_LOG_BATCH_SIZE]
+        del _admin_log_buffer[:ADMIN_LOG_BATCH_SIZE]
+        try:
+            await _execute(get_supabase_client().table("admin_logs").insert(batch))
+        except Exception as e:
+            _log_error("log_admin_action", e)
+
+async def run_admin_log_writer():
+    """Background task that flushes buffered admin actions ADMIN_LOG_FLUSH_INTERVAL seconds after they arrive."""
+    while True:
+        await _admin_log_pending.wait()
+        await asyncio.sleep(ADMIN_LOG_FLUSH_INTERVAL)
+        await flush_admin_logs()
+
+def _ensure_admin_log_writer():
+    """Starts run_admin_log_writer if it isn't already running."""
+    global _admin_log_writer_task
+    if _admin_log_writer_task is None or _admin_log_writer_task.done():
+        _admin_log_writer_task = asyncio.get_running_loop().create_task(run_admin_log_writer())
+
+async def stop_admin_log_writer():
+    """Stops the background writer and writes whatever is still buffered."""
+    global _admin_log_writer_task
+    if _admin_log_writer_task is not None:
+        _admin_log_writer_task.cancel()
+        try:
+            await _admin_log_writer_task
+        except asyncio.CancelledError:
+            pass
+        _admin_log_writer_task = None
+    await flush_admin_logs()
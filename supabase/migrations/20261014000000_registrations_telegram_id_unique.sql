@@ -0,0 +1,18 @@
+-- register_user_if_new upserts with ON CONFLICT (telegram_id), which needs a unique constraint
+-- (or non-partial unique index) on exactly that column. Add one unless it already exists.
+do $$
+begin
+  if not exists (
+    select 1
+    from pg_index i
+    join pg_attribute a on a.attrelid = i.indrelid and a.attnum = i.indkey[0]
+    where i.indrelid = 'registrations'::regclass
+      and i.indisunique
+      and i.indpred is null
+      and i.indnkeyatts = 1
+      and a.attname = 'telegram_id'
+  ) then
+    alter table registrations add constraint registrations_telegram_id_key unique (telegram_id);
+  end if;
+end
+$$;
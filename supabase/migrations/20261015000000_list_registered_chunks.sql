@@ -0,0 +1,21 @@
+-- Formats the registered users list for the /list admin command, pre-split into
+-- chunks of `chunk_size` lines so each chunk fits in a single Telegram message.
+create or replace function list_registered_chunks(chunk_size int default 50)
+returns table (chunk text)
+language sql
+stable
+as $$
+  select string_agg(line, E'\n' order by rn)
+  from (
+    select
+      row_number() over (order by telegram_id) - 1 as rn,
+      format(
+        '- `%s`%s',
+        telegram_id,
+        case when username is not null then ' (@' || username || ')' else '' end
+      ) as line
+    from registrations
+  ) t
+  group by rn / chunk_size
+  order by rn / chunk_size;
+$$;
@@ -0,0 +1,2 @@
+-- Soft-delete marker for users who blocked the bot; broadcasts skip rows where it is set.
+alter table registrations add column if not exists blocked_at timestamptz;
@@ -0,0 +1,25 @@
+-- Users who blocked the bot (blocked_at set) are treated as unregistered, so leave them out of /list.
+create or replace function list_registered_chunks(chunk_size int default 50)
+returns table (chunk text)
+language sql
+stable
+as $$
+  select string_agg(line, E'\n' order by rn)
+  from (
+    select
+      row_number() over (order by telegram_id) - 1 as rn,
+      format(
+        '- <code>%s</code>%s',
+        telegram_id,
+        case
+          when username is not null then
+            ' (@' || replace(replace(replace(username, '&', '&amp;'), '<', '&lt;'), '>', '&gt;') || ')'
+          else ''
+        end
+      ) as line
+    from registrations
+    where blocked_at is null
+  ) t
+  group by rn / chunk_size
+  order by rn / chunk_size;
+$$;